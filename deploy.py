@@ -3,7 +3,6 @@
 # dependencies = [
 #   "questionary>=2.0.0",
 #   "rich>=13.0.0",
-#   "tomli-w>=1.0.0",
 #   "typer>=0.9.0",
 # ]
 # requires-python = ">=3.11"
@@ -19,12 +18,19 @@ Usage:
     uv run deploy.py --stop       # Stop service
 """
 
+import hashlib
+import json
+import math
+import os
+import re
+import select
+import shlex
+import stat
 import subprocess
 import sys
+import time
 from pathlib import Path
 import tomllib
-import tomli_w
-import questionary
 import typer
 from rich.console import Console
 from rich.panel import Panel
@@ -36,10 +42,32 @@ console = Console()
 # Configuration paths
 CONFIG_DIR = Path.home() / ".config" / "jupyter-lab"
 CONFIG_FILE = CONFIG_DIR / "config.toml"
+CONFIG_CACHE_FILE = CONFIG_FILE.with_suffix(".cache.json")
 DATA_DIR = Path.home() / ".local" / "share" / "jupyter-lab"
 CACHE_DIR = DATA_DIR / ".uv-cache"
 SERVICE_FILE = Path.home() / ".config" / "systemd" / "user" / "jupyter-lab.service"
 
+# Image build
+IMAGE_REPO = "localhost/jupyter-lab"
+IMAGE_HASH_LABEL = "content.hash"
+# Files that affect the image; the Dockerfile does not COPY anything from the context
+BUILD_FILES = ["Dockerfile"]
+
+# Service state
+SERVICE_PROPERTIES = ["ActiveState", "SubState", "MainPID", "ExecMainStartTimestamp", "NeedDaemonReload"]
+_LOGS_MARKER = "--- jupyter-lab logs ---"
+_RELOAD_FAILED = "deploy:reload-failed"
+_ENABLE_FAILED = "deploy:enable-failed"
+# Properties and, once fetched for display, recent logs
+_service_state: Optional[tuple[dict[str, str], Optional[str]]] = None
+# Logged by Jupyter Server once it is accepting connections
+READY_MARKER = b"is running at"
+READY_TIMEOUT = 10.0
+# Logged by systemd when the unit's main process ends; prompts a state check
+STOPPED_MARKERS = (b"Main process exited", b"Failed with result", b"Deactivated successfully")
+# Fallback state check interval for when the journal has gone quiet
+READY_POLL_INTERVAL = 3.0
+
 # Default values
 DEFAULTS = {
     "ai": {
@@ -50,7 +78,7 @@ DEFAULTS = {
         "notebooks_dir": str(Path.home() / "Documents" / "jupyter"),
     },
     "container": {
-        "image_name": "localhost/jupyter-lab:latest",
+        "image_name": f"{IMAGE_REPO}:latest",
         "port": 8888,
     },
 }
@@ -61,19 +89,97 @@ class DeploymentError(Exception):
     pass
 
 
+def _write_config_cache(st: os.stat_result, config: dict):
+    """Atomically write parsed config, keyed by the TOML file's mtime and size"""
+    tmp = CONFIG_CACHE_FILE.with_suffix(".tmp")
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"key": [st.st_mtime_ns, st.st_size], "config": config}, f)
+        os.replace(tmp, CONFIG_CACHE_FILE)
+    except (OSError, TypeError, ValueError):
+        # Cache is best-effort (e.g. hand-edited TOML dates aren't JSON);
+        # the TOML file stays the source of truth
+        tmp.unlink(missing_ok=True)
+
+
+def _toml_key(key: str) -> str:
+    """Format a TOML key, quoting it unless it is a valid bare key"""
+    return key if re.fullmatch(r"[A-Za-z0-9_-]+", key) else json.dumps(key)
+
+
+def _toml_value(value) -> str:
+    """Format a TOML string, int, float, bool or array of those"""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        if math.isnan(value):
+            return "nan"
+        if math.isinf(value):
+            return "inf" if value > 0 else "-inf"
+        return repr(value)
+    if isinstance(value, list):
+        return "[" + ", ".join(_toml_value(v) for v in value) + "]"
+    if isinstance(value, str):
+        # JSON string escapes are a subset of TOML basic string escapes, but JSON
+        # leaves DEL raw while TOML requires it to be escaped
+        return json.dumps(value, ensure_ascii=False).replace("\x7f", "\\u007f")
+    raise TypeError(f"Unsupported config value type: {type(value).__name__}")
+
+
+def _emit_toml(config: dict) -> str:
+    """Serialize a config dict of scalars and one level of tables to TOML"""
+    lines = [f"{_toml_key(k)} = {_toml_value(v)}" for k, v in config.items() if not isinstance(v, dict)]
+    for table, values in config.items():
+        if not isinstance(values, dict):
+            continue
+        if lines:
+            lines.append("")
+        lines.append(f"[{_toml_key(table)}]")
+        lines.extend(f"{_toml_key(k)} = {_toml_value(v)}" for k, v in values.items())
+    return "\n".join(lines) + "\n"
+
+
 def load_config() -> dict:
-    """Load config from TOML file"""
-    if CONFIG_FILE.exists():
-        with open(CONFIG_FILE, "rb") as f:
-            return tomllib.load(f)
-    return {}
+    """Load config from TOML file, using the parsed cache when it is fresh"""
+    try:
+        st = CONFIG_FILE.stat()
+    except FileNotFoundError:
+        return {}
+
+    # JSON rather than pickle: CONFIG_DIR is mounted read-write into the
+    # container, so the cache must not be able to run code on the host
+    try:
+        with open(CONFIG_CACHE_FILE, encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached["key"] == [st.st_mtime_ns, st.st_size] and isinstance(cached["config"], dict):
+            return cached["config"]
+    except Exception:
+        pass
+
+    with open(CONFIG_FILE, "rb") as f:
+        config = tomllib.load(f)
+    _write_config_cache(st, config)
+    return config
 
 
 def save_config(config: dict):
     """Save config to TOML file"""
+    try:
+        content = _emit_toml(config)
+    except TypeError as e:
+        # Hand-edited values (dates, nested tables) that the writer doesn't support
+        console.print(f"[red]Error:[/red] Cannot save configuration: {e}")
+        console.print(f"Fix the value in {CONFIG_FILE} and re-run")
+        sys.exit(1)
+    # Compare re-emitted text rather than dicts so NaN values compare equal
+    assert _emit_toml(tomllib.loads(content)) == content, "TOML round-trip mismatch"
+
     CONFIG_DIR.mkdir(parents=True, exist_ok=True)
-    with open(CONFIG_FILE, "wb") as f:
-        tomli_w.dump(config, f)
+    CONFIG_FILE.write_text(content, encoding="utf-8")
+    _write_config_cache(CONFIG_FILE.stat(), config)
 
 
 def is_config_complete(config: dict) -> tuple[bool, list[str]]:
@@ -90,6 +196,8 @@ def is_config_complete(config: dict) -> tuple[bool, list[str]]:
 
 def prompt_config(existing_config: dict = None) -> dict:
     """Interactively prompt for configuration"""
+    import questionary
+
     existing_config = existing_config or {}
 
     console.print("\n[bold]Configuration Setup[/bold]\n")
@@ -166,44 +274,111 @@ def run_command(cmd: list[str], error_msg: str, continue_on_error=True) -> bool:
             raise DeploymentError(error_msg)
 
 
+def shell_pipeline(steps: list[list[str]]) -> list[str]:
+    """Build a single `sh -c` command running steps in order, stopping at the first failure"""
+    return ["sh", "-c", " && ".join(shlex.join(step) for step in steps)]
+
+
+def _fetch_service_state(with_logs=False) -> tuple[dict[str, str], str]:
+    """Fetch service properties, plus recent logs in the same shell if asked, memoized until start/stop"""
+    global _service_state
+    if _service_state is None or (with_logs and _service_state[1] is None):
+        steps = [["systemctl", "--user", "show", "jupyter-lab.service",
+                  f"--property={','.join(SERVICE_PROPERTIES)}"]]
+        if with_logs:
+            steps += [
+                ["echo", _LOGS_MARKER],
+                ["journalctl", "--user", "-u", "jupyter-lab.service", "-n", "10", "--no-pager"],
+            ]
+        try:
+            result = subprocess.run(shell_pipeline(steps), capture_output=True, text=True)
+            output = result.stdout
+        except Exception:
+            output = ""
+        props_text, _, logs = output.partition(f"{_LOGS_MARKER}\n")
+        props = {}
+        for line in props_text.splitlines():
+            key, sep, value = line.partition("=")
+            if sep:
+                props[key] = value
+        _service_state = (props, logs if with_logs else None)
+    props, logs = _service_state
+    return props, logs or ""
+
+
+def _service_props() -> dict[str, str]:
+    """Return the service's systemd properties"""
+    return _fetch_service_state()[0]
+
+
+def _invalidate_service_state():
+    """Forget memoized service state after changing it"""
+    global _service_state
+    _service_state = None
+
+
 def check_service_status() -> tuple[bool, str]:
     """Check if systemd service is running"""
-    try:
-        result = subprocess.run(
-            ["systemctl", "--user", "is-active", "jupyter-lab.service"],
-            capture_output=True,
-            text=True
-        )
-        is_running = result.returncode == 0
-        status = result.stdout.strip()
-        return is_running, status
-    except Exception:
-        return False, "unknown"
+    status = _service_props().get("ActiveState") or "unknown"
+    # Matches `systemctl is-active`, which also succeeds while reloading
+    return status in ("active", "reloading"), status
+
+
+def build_context_hash() -> str:
+    """Hash the files that make up the image build"""
+    digest = hashlib.blake2b(digest_size=16)
+    for name in BUILD_FILES:
+        path = Path(__file__).parent / name
+        digest.update(name.encode() + b"\0")
+        with open(path, "rb") as f:
+            digest.update(hashlib.file_digest(f, "blake2b").digest())
+    return digest.hexdigest()
+
+
+def image_content_hash() -> str:
+    """Return the content hash label of the latest image, or "" if unavailable"""
+    result = subprocess.run(
+        ["podman", "inspect", "--format",
+         f'{{{{index .Config.Labels "{IMAGE_HASH_LABEL}"}}}}', f"{IMAGE_REPO}:latest"],
+        capture_output=True,
+        text=True
+    )
+    return result.stdout.strip() if result.returncode == 0 else ""
 
 
 def build_image(force=False):
-    """Build container image"""
+    """Build container image, skipping the build if its inputs are unchanged"""
     console.print("\n[bold]Building container image...[/bold]")
 
-    # Check if image exists
-    if not force:
-        result = subprocess.run(
-            ["podman", "images", "-q", "localhost/jupyter-lab:latest"],
-            capture_output=True,
-            text=True
-        )
-        if result.stdout.strip():
-            console.print("[green]✓[/green] Image already exists (use --rebuild to force)")
-            return True
+    content_hash = build_context_hash()
+    previous_hash = image_content_hash()
+    if not force and previous_hash == content_hash:
+        console.print("[green]✓[/green] Image is up to date (use --rebuild to force)")
+        return True
 
     with console.status("[bold green]Building..."):
         success = run_command(
-            ["podman", "build", "-t", "localhost/jupyter-lab:latest", str(Path(__file__).parent)],
+            [
+                "podman", "build",
+                "--label", f"{IMAGE_HASH_LABEL}={content_hash}",
+                "-t", f"{IMAGE_REPO}:{content_hash}",
+                "-t", f"{IMAGE_REPO}:latest",
+                str(Path(__file__).parent),
+            ],
             "Failed to build image"
         )
         if success:
             console.print("[green]✓[/green] Image built successfully")
-        return success
+
+    # Drop the superseded hash tag so the old image becomes dangling and
+    # `podman image prune` can reclaim it
+    if success and previous_hash != content_hash and re.fullmatch(r"[0-9a-f]{32}", previous_hash):
+        run_command(
+            ["podman", "untag", f"{IMAGE_REPO}:{previous_hash}"],
+            "Failed to remove old image tag",
+            continue_on_error=True
+        )
+    return success
 
 
 def create_directories(config: dict):
@@ -224,10 +399,64 @@ def create_directories(config: dict):
             console.print(f"[yellow]⚠[/yellow] Failed to create {dir_path}: {e}")
 
 
+def _copy_fd_range(src_fd: int, dst_fd: int, size: int):
+    """Copy size bytes between file positions with copy_file_range (reflinks where supported)"""
+    while size > 0:
+        copied = os.copy_file_range(src_fd, dst_fd, size)
+        if copied == 0:
+            break
+        size -= copied
+
+
+def _copy_fd_sendfile(src_fd: int, dst_fd: int, size: int):
+    """Copy size bytes between file positions with sendfile"""
+    while size > 0:
+        copied = os.sendfile(dst_fd, src_fd, None, size)
+        if copied == 0:
+            break
+        size -= copied
+
+
+def _fast_copy(src: Path, dst: Path):
+    """Copy a file in the kernel where possible, preserving its mode and times like shutil.copy2"""
+    with open(src, "rb") as fsrc:
+        st = os.fstat(fsrc.fileno())
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, "wb") as fdst:
+            for copy in (_copy_fd_range, _copy_fd_sendfile):
+                try:
+                    copy(fsrc.fileno(), fdst.fileno(), st.st_size)
+                    break
+                except (AttributeError, OSError):
+                    # Unsupported here (old kernel, cross-device, non-Linux); start over
+                    fsrc.seek(0)
+                    fdst.seek(0)
+                    fdst.truncate()
+            else:
+                import shutil
+                shutil.copyfileobj(fsrc, fdst)
+
+            # Set explicitly: O_CREAT's mode is masked by the umask and ignored
+            # for files that already exist
+            fdst.flush()
+            os.fchmod(fd, stat.S_IMODE(st.st_mode))
+            os.utime(fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def _copy_tree(src: Path, dst: Path):
+    """Recursively copy a directory, overwriting existing files"""
+    os.makedirs(dst, exist_ok=True)
+    with os.scandir(src) as entries:
+        for entry in entries:
+            target = dst / entry.name
+            if entry.is_dir():
+                _copy_tree(Path(entry.path), target)
+            else:
+                _fast_copy(Path(entry.path), target)
+
+
 def copy_jupyter_config():
     """Copy Jupyter config templates if they don't exist"""
-    import shutil
-
     configs = [
         ("jupyter_lab_config.py", "Jupyter Lab config"),
         ("ipython_kernel_config.py", "IPython kernel config"),
@@ -239,7 +468,7 @@ def copy_jupyter_config():
 
         if not dest.exists() and src.exists():
             try:
-                shutil.copy2(src, dest)
+                _fast_copy(src, dest)
                 console.print(f"[green]✓[/green] Copied {description} to {dest}")
             except Exception as e:
                 console.print(f"[yellow]⚠[/yellow] Failed to copy {description}: {e}")
@@ -250,14 +479,14 @@ def copy_jupyter_config():
 
     if ipython_src.exists():
         try:
-            shutil.copytree(ipython_src, ipython_dest, dirs_exist_ok=True)
+            _copy_tree(ipython_src, ipython_dest)
             console.print(f"[green]✓[/green] Copied IPython startup scripts to {ipython_dest}")
         except Exception as e:
             console.print(f"[yellow]⚠[/yellow] Failed to copy IPython config: {e}")
 
 
-def install_systemd_service(config: dict):
-    """Install systemd service file"""
+def install_systemd_service(config: dict) -> bool:
+    """Install systemd service file, returning True if systemd needs a reload"""
     console.print("\n[bold]Installing systemd service...[/bold]")
 
     service_content = f"""[Unit]
@@ -293,42 +522,74 @@ ExecStop=/usr/bin/podman stop -t 10 jupyter-lab
 WantedBy=default.target
 """
 
+    content = service_content.encode()
+    try:
+        unchanged = (
+            SERVICE_FILE.stat().st_size == len(content)
+            and SERVICE_FILE.read_bytes() == content
+        )
+    except FileNotFoundError:
+        unchanged = False
+
+    if unchanged:
+        console.print(f"[green]✓[/green] {SERVICE_FILE} (unchanged)")
+        return _service_props().get("NeedDaemonReload") == "yes"
+
     SERVICE_FILE.parent.mkdir(parents=True, exist_ok=True)
-    SERVICE_FILE.write_text(service_content)
+    tmp = SERVICE_FILE.with_suffix(".tmp")
+    tmp.write_bytes(content)
+    os.replace(tmp, SERVICE_FILE)
     console.print(f"[green]✓[/green] {SERVICE_FILE}")
-
-    # Reload systemd
-    if run_command(
-        ["systemctl", "--user", "daemon-reload"],
-        "Failed to reload systemd",
-        continue_on_error=True
-    ):
-        console.print("[green]✓[/green] Systemd configuration reloaded")
+    return True
 
 
-def start_service():
-    """Start systemd service"""
+def start_service(reload=False):
+    """Reload systemd if needed, then start and enable the service in one shell"""
     console.print("\n[bold]Starting service...[/bold]")
 
+    # Only a failed start is fatal; reload and enable failures are reported as
+    # warnings via markers on stderr, as when they ran as separate commands
+    start = shlex.join(["systemctl", "--user", "start", "jupyter-lab.service"])
+    enable = shlex.join(["systemctl", "--user", "enable", "jupyter-lab.service"])
+    script = f"{start} && {{ {enable} || echo {_ENABLE_FAILED} >&2; }}"
+    if reload:
+        daemon_reload = shlex.join(["systemctl", "--user", "daemon-reload"])
+        script = f"{daemon_reload} || echo {_RELOAD_FAILED} >&2; {script}"
+
+    _invalidate_service_state()
     with console.status("[bold green]Starting..."):
-        if run_command(
-            ["systemctl", "--user", "start", "jupyter-lab.service"],
-            "Failed to start service"
-        ):
-            run_command(
-                ["systemctl", "--user", "enable", "jupyter-lab.service"],
-                "Failed to enable service",
-                continue_on_error=True
-            )
-            console.print("[green]✓[/green] Service started")
-            return True
-    return False
+        result = subprocess.run(["sh", "-c", script], capture_output=True, text=True)
+
+    stderr = "\n".join(
+        line for line in result.stderr.splitlines()
+        if line not in (_RELOAD_FAILED, _ENABLE_FAILED)
+    ).strip()
+
+    if reload:
+        if _RELOAD_FAILED in result.stderr:
+            console.print("[yellow]⚠[/yellow] Failed to reload systemd")
+        else:
+            console.print("[green]✓[/green] Systemd configuration reloaded")
+
+    if result.returncode != 0:
+        console.print("[yellow]⚠[/yellow] Failed to start service")
+        if stderr:
+            console.print(f"[dim]{stderr}[/dim]")
+        return False
+
+    if _ENABLE_FAILED in result.stderr:
+        console.print("[yellow]⚠[/yellow] Failed to enable service")
+        if stderr:
+            console.print(f"[dim]{stderr}[/dim]")
+    console.print("[green]✓[/green] Service started")
+    return True
 
 
 def stop_service():
     """Stop systemd service"""
     console.print("\n[bold]Stopping service...[/bold]")
 
+    _invalidate_service_state()
     if run_command(
         ["systemctl", "--user", "stop", "jupyter-lab.service"],
         "Failed to stop service"
@@ -338,8 +599,61 @@ def stop_service():
     return False
 
 
+def _unit_stopped() -> bool:
+    """Re-read the unit state and report whether it has failed, stopped or is waiting to restart"""
+    _invalidate_service_state()
+    _, status = check_service_status()
+    return status in ("failed", "inactive", "deactivating") or \
+        _service_props().get("SubState") == "auto-restart"
+
+
+def wait_until_ready(since: float, timeout: float = READY_TIMEOUT) -> Optional[bool]:
+    """Follow the journal from `since` until Jupyter reports it is serving, or the unit fails or stops
+
+    Returns None if the journal could not be followed at all.
+    """
+    try:
+        proc = subprocess.Popen(
+            ["journalctl", "--user", "-u", "jupyter-lab.service", "-f", "-o", "cat",
+             f"--since=@{since:.6f}"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+    except OSError:
+        return None
+
+    fd = proc.stdout.fileno()
+    deadline = time.monotonic() + timeout
+    keep = max(len(m) for m in (READY_MARKER, *STOPPED_MARKERS))
+    tail = b""
+    try:
+        while (remaining := deadline - time.monotonic()) > 0:
+            ready, _, _ = select.select([fd], [], [], min(remaining, READY_POLL_INTERVAL))
+            if not ready:
+                if _unit_stopped():
+                    return False
+                continue
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                # journalctl exited (no user journal, no permission)
+                return None
+            # Keep enough of the previous chunk to match a marker split across reads
+            tail = tail[-keep:] + chunk
+            if READY_MARKER in tail:
+                return True
+            if any(m in tail for m in STOPPED_MARKERS):
+                tail = b""
+                if _unit_stopped():
+                    return False
+        return False
+    finally:
+        proc.kill()
+        proc.wait()
+
+
 def show_status(config: dict):
     """Show service status and information"""
+    props, logs = _fetch_service_state(with_logs=True)
     is_running, status = check_service_status()
 
     if is_running:
@@ -347,17 +661,16 @@ def show_status(config: dict):
             "[green]✓[/green] Jupyter Lab is running\n\n"
             f"Access at: [blue]http://localhost:{config['container']['port']}[/blue]\n"
             f"Notebooks: [cyan]{config['paths']['notebooks_dir']}[/cyan]\n"
-            f"Service: [dim]jupyter-lab.service[/dim]"
+            f"Service: [dim]jupyter-lab.service (PID {props.get('MainPID', '?')})[/dim]"
         )
+        if props.get("ExecMainStartTimestamp"):
+            panel_content += f"\nStarted: [dim]{props['ExecMainStartTimestamp']}[/dim]"
 
         console.print(Panel.fit(panel_content, title="Jupyter Lab Status", border_style="green"))
 
         # Show recent logs
         console.print("\n[bold]Recent logs:[/bold]")
-        subprocess.run(
-            ["journalctl", "--user", "-u", "jupyter-lab.service", "-n", "10", "--no-pager"],
-            check=False
-        )
+        console.print(logs.rstrip(), markup=False, highlight=False)
 
         console.print("\n[dim]Commands:[/dim]")
         console.print("  [cyan]systemctl --user restart jupyter-lab[/cyan]  # Restart")
@@ -365,7 +678,7 @@ def show_status(config: dict):
         console.print("  [cyan]uv run deploy.py --stop[/cyan]             # Stop service")
     else:
         console.print(Panel.fit(
-            f"[yellow]⚠[/yellow] Service is not running (status: {status})",
+            f"[yellow]⚠[/yellow] Service is not running (status: {status}/{props.get('SubState', 'unknown')})",
             title="Jupyter Lab Status",
             border_style="yellow"
         ))
@@ -421,16 +734,21 @@ def main(
 
     create_directories(config)
     copy_jupyter_config()
-    install_systemd_service(config)
+    needs_reload = install_systemd_service(config)
 
     # Start or restart service
     if is_running:
         console.print("\n[bold]Restarting service...[/bold]")
         stop_service()
 
-    if start_service():
-        import time
-        time.sleep(2)  # Give service time to start
+    started_at = time.time()
+    if start_service(reload=needs_reload):
+        with console.status("[bold green]Waiting for Jupyter Lab..."):
+            ready = wait_until_ready(started_at)
+        if ready is None:
+            console.print("[yellow]⚠[/yellow] Could not follow the service journal to wait for Jupyter Lab")
+        elif not ready and check_service_status()[0]:
+            console.print(f"[yellow]⚠[/yellow] Jupyter Lab not ready after {READY_TIMEOUT:.0f}s, it may still be starting")
         show_status(config)
     else:
         console.print("[red]✗[/red] Failed to start service. Check logs:")